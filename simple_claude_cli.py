@@ -7,21 +7,231 @@ execute local commands (bash, git, rg, gh, curl, etc.) to accomplish coding task
 """
 
 import os
-import sys
+import atexit
+import asyncio
 import json
+import re
+import sys
+import time
+import random
+import shlex
+import shutil
+import signal
+import importlib.util
+import secrets
+import selectors
+import tempfile
 import subprocess
-from typing import Any, Dict, List
-from anthropic import Anthropic
+import threading
+import functools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from datetime import datetime, timezone
+from typing import Any, Callable, Deque, Dict, List, Mapping, Optional, Tuple, Union
+
+# anthropic and httpx are imported where they are needed, as importing them
+# takes a noticeable part of the CLI's startup time
+
+# Number of bytes kept from the start and the end of each output stream of a
+# command; everything in between is only shown on the terminal
+OUTPUT_HEAD = 4 * 1024
+OUTPUT_TAIL = 4 * 1024
+
+# Seconds to wait for a command to exit after it was interrupted on timeout
+_KILL_GRACE = 2
+
+# Prefix of the line carrying a command's exit code in the persistent shell.
+# The random part keeps it from matching anything else the shell prints.
+_SENTINEL = f"__SCC_END_{secrets.token_hex(8)}__"
+_SENTINEL_RE = re.compile(re.escape(_SENTINEL.encode()) + rb"(-?\d+)\n")
+
+# Characters with a special meaning to the shell. Commands without any of
+# them can be split with shlex and executed without a shell.
+_SHELL_META_RE = re.compile(r"[|&;<>$`*?(){}\[\]\"'\\\n~#]")
+
+# Commands starting with one of these prefixes only read state, so their
+# results can be reused until some other command runs
+_PURE_PREFIXES = (
+    "git status", "git log", "git diff", "git show", "rg ", "grep ", "ls",
+    "cat ", "find ", "wc ", "head ", "tail ", "pwd", "which ", "file ",
+    "command -v ", "git rev-parse",
+)
+
+# Failing read-only commands that exit with one of these codes within
+# _NEG_CACHE_MAX_DURATION seconds are remembered for _NEG_CACHE_TTL seconds
+_NEG_CACHE_SIZE = 512
+_NEG_CACHE_EXIT_CODES = (1, 127, 128)
+_NEG_CACHE_MAX_DURATION = 1.0
+_NEG_CACHE_TTL = 60.0
+
+# Types of errors the API reports in the event stream of a response that
+# has already started; like 429 and 5xx responses they are worth a retry
+_RETRYABLE_ERROR_TYPES = frozenset({"api_error", "overloaded_error", "rate_limit_error", "timeout_error"})
+
+# Redirects, command chaining and substitutions, find actions or git's
+# --output turn an otherwise read-only command into one that may change state
+_IMPURE_RE = re.compile(r"[;&|<>`$\n]|\s-(?:delete|exec(?:dir)?|ok(?:dir)?|fprint[0f]?|fls)\b|--output\b")
+
+
+def _is_pure_command(command: str) -> bool:
+    """Return True if the command only reads state and may be memoized."""
+    command = command.strip()
+    return command.startswith(_PURE_PREFIXES) and not _IMPURE_RE.search(command)
+
+
+class _OutputCapture:
+    """Bounded capture of a command's output stream.
+    
+    Keeps the first OUTPUT_HEAD and the last OUTPUT_TAIL bytes, so memory use
+    and the size of tool results stay constant however much a command prints.
+    """
+    
+    __slots__ = ("head", "tail", "total")
+    
+    def __init__(self):
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+    
+    def feed(self, chunk: bytes):
+        """Add a chunk of output."""
+        self.total += len(chunk)
+        room = OUTPUT_HEAD - len(self.head)
+        if room > 0:
+            self.head += chunk[:room]
+            chunk = chunk[room:]
+        if chunk:
+            self.tail += chunk
+            del self.tail[:-OUTPUT_TAIL]
+    
+    def text(self) -> str:
+        """Return the captured output, marking where bytes were left out."""
+        omitted = self.total - len(self.head) - len(self.tail)
+        data = bytes(self.head)
+        if omitted:
+            data += f"\n...[truncated {omitted} bytes]...\n".encode()
+        data += self.tail
+        return data.decode("utf-8", errors="replace")
+
+
+def _kill_process_group(pid: int):
+    """Kill a process group, ignoring it if it is already gone."""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _estimate_tokens(message: Dict[str, Any]) -> int:
+    """Roughly estimate the number of tokens a message takes up."""
+    return len(json.dumps(message, separators=(",", ":"), default=str)) // 4
+
+
+def _is_retryable_status_error(status_code: int, body: Any) -> bool:
+    """Return True if an API error response is worth retrying.
+    
+    Errors sent as an event after the stream started arrive with the status
+    code of the successful response, 200; their body tells what went wrong.
+    """
+    if status_code == 200:
+        error = body.get("error") if isinstance(body, dict) else None
+        return isinstance(error, dict) and error.get("type") in _RETRYABLE_ERROR_TYPES
+    return status_code in (408, 409) or status_code >= 500
+
+
+def _retry_delay(headers: Mapping[str, str], attempt: int) -> float:
+    """Return how long to wait before retrying a rate-limited request.
+    
+    Uses the Retry-After header if present, then the time until the request
+    rate limit resets, and falls back to exponential backoff with jitter.
+    """
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+    
+    reset = headers.get("anthropic-ratelimit-requests-reset")
+    if reset:
+        try:
+            reset_at = datetime.fromisoformat(reset.replace("Z", "+00:00"))
+            return max(0.0, (reset_at - datetime.now(timezone.utc)).total_seconds())
+        except ValueError:
+            pass
+    
+    return min(60.0, 2 ** attempt + random.random())
+
+
+@functools.lru_cache(maxsize=1)
+def _build_system_prompt() -> str:
+    """Build the system prompt for the agent."""
+    return """You are a helpful coding assistant with access to bash commands.
+
+You can execute commands on the user's local machine to help with coding tasks.
+When given a task, you should:
+1. Create a plan
+2. Execute necessary commands to accomplish the task
+3. Iterate based on results (e.g., fix tests if they fail)
+4. Provide clear feedback about what you're doing
+
+You have access to tools like: bash, git, rg (ripgrep), gh (GitHub CLI), curl, and any other standard Unix utilities.
+
+Always explain what you're doing and why. Be concise but thorough.
+
+IMPORTANT SECURITY NOTE: You are executing commands on the user's machine. Be careful and:
+- Avoid destructive operations without explaining them first
+- Don't execute commands that could harm the system
+- Be cautious with rm, chmod, and other potentially dangerous commands
+- Always validate paths and inputs when possible"""
+
+
+@functools.lru_cache(maxsize=1)
+def _get_tools() -> List[Dict[str, Any]]:
+    """Define the tools available to Claude."""
+    return [
+        {
+            "name": "execute_bash",
+            "description": "Execute a bash command on the local machine. Returns stdout, stderr, and exit code. Use this to run any command including git, rg, gh, curl, etc. The command runs in the current working directory.",
+            "input_schema": {
+                "type": "object",
+                "properties": {
+                    "command": {
+                        "type": "string",
+                        "description": "The bash command to execute. Can be a single command or a pipeline."
+                    },
+                    "description": {
+                        "type": "string",
+                        "description": "A brief description of what this command does (for logging purposes)."
+                    }
+                },
+                "required": ["command", "description"]
+            },
+            # Caches all tool definitions up to and including this one
+            "cache_control": {"type": "ephemeral"}
+        }
+    ]
 
 
 class ClaudeAgentCLI:
     """CLI for interacting with Claude using tool calling."""
     
+    __slots__ = (
+        "api_key", "_http", "client", "model", "command_timeout", "max_retries",
+        "requests_per_minute", "_request_times", "_max_history_tokens",
+        "conversation_history", "_messages_view", "system_prompt",
+        "_pool", "_print_lock", "_shell", "_shell_dir", "_shell_lock", "_cmd_cache",
+        "_cmd_cache_max", "_cmd_cache_generation", "_cmd_cache_lock", "_neg_cache",
+    )
+    
     def __init__(
         self, 
         api_key: str = None, 
         model: str = "claude-3-7-sonnet-20250219",
-        command_timeout: int = 300
+        command_timeout: int = 300,
+        max_retries: int = 5,
+        requests_per_minute: Optional[int] = None
     ):
         """Initialize the CLI with API credentials.
         
@@ -29,6 +239,8 @@ class ClaudeAgentCLI:
             api_key: Anthropic API key (defaults to ANTHROPIC_API_KEY env var)
             model: Claude model to use
             command_timeout: Timeout in seconds for bash command execution (default: 300)
+            max_retries: How often to retry API calls failing with 429 or 5xx (default: 5)
+            requests_per_minute: Pace API calls to stay below this rate (default: no pacing)
         """
         self.api_key = api_key or os.environ.get("ANTHROPIC_API_KEY")
         if not self.api_key:
@@ -36,102 +248,155 @@ class ClaudeAgentCLI:
                 "ANTHROPIC_API_KEY environment variable must be set or api_key parameter must be provided"
             )
         
-        self.client = Anthropic(api_key=self.api_key)
+        import httpx
+        from anthropic import AsyncAnthropic
+        
+        # Long-lived connections save a TCP and TLS handshake per turn, and
+        # HTTP/2 is used when the h2 package is installed
+        self._http = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=300),
+            timeout=httpx.Timeout(60.0, connect=10.0)
+        )
+        # Retries are handled in _stream_response, which also honors the
+        # rate limit reset headers
+        self.client = AsyncAnthropic(api_key=self.api_key, max_retries=0, http_client=self._http)
         self.model = model
         self.command_timeout = command_timeout
-        self.conversation_history: List[Dict[str, Any]] = []
-        self.system_prompt = self._build_system_prompt()
+        self.max_retries = max_retries
+        self.requests_per_minute = requests_per_minute
+        self._request_times: deque = deque()
+        # Once the conversation grows beyond this many (estimated) tokens,
+        # older tool results are shortened by _compact_history
+        self._max_history_tokens = 32000
+        # Only ever appended to; use _append_message so the cached request
+        # messages built from it are invalidated
+        self.conversation_history: Deque[Dict[str, Any]] = deque()
+        self._messages_view: Optional[List[Dict[str, Any]]] = None
+        # Marked as a cache breakpoint, like the tools, so Anthropic's prompt
+        # cache can reuse it on every turn instead of processing it again
+        self.system_prompt = [{
+            "type": "text",
+            "text": _build_system_prompt(),
+            "cache_control": {"type": "ephemeral"}
+        }]
+        # Tool calls of one turn run concurrently; the lock keeps their
+        # progress output from interleaving
+        self._pool = ThreadPoolExecutor(max_workers=8)
+        self._print_lock = threading.Lock()
+        # Long-lived bash process commands are sent to, so that not every
+        # command has to spawn a shell; started on first use
+        self._shell: Optional[subprocess.Popen] = None
+        self._shell_dir: Optional[str] = None
+        self._shell_lock = threading.Lock()
+        atexit.register(self._stop_shell)
+        # LRU cache of read-only command results keyed by (cwd, command).
+        # The generation counter is bumped on every invalidation so results
+        # of commands racing with a state-changing command are not stored.
+        self._cmd_cache: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self._cmd_cache_max = 256
+        self._cmd_cache_generation = 0
+        self._cmd_cache_lock = threading.Lock()
+        # Direct-mapped table of recent fast failures of read-only commands,
+        # indexed by the hash of the command. Slots hold (key, result, time
+        # stored) and are simply overwritten on collision. Invalidated
+        # together with _cmd_cache.
+        self._neg_cache: List[Optional[Tuple[tuple, Dict[str, Any], float]]] = [None] * _NEG_CACHE_SIZE
         
-    def _build_system_prompt(self) -> str:
-        """Build the system prompt for the agent."""
-        return """You are a helpful coding assistant with access to bash commands.
-
-You can execute commands on the user's local machine to help with coding tasks.
-When given a task, you should:
-1. Create a plan
-2. Execute necessary commands to accomplish the task
-3. Iterate based on results (e.g., fix tests if they fail)
-4. Provide clear feedback about what you're doing
-
-You have access to tools like: bash, git, rg (ripgrep), gh (GitHub CLI), curl, and any other standard Unix utilities.
-
-Always explain what you're doing and why. Be concise but thorough.
-
-IMPORTANT SECURITY NOTE: You are executing commands on the user's machine. Be careful and:
-- Avoid destructive operations without explaining them first
-- Don't execute commands that could harm the system
-- Be cautious with rm, chmod, and other potentially dangerous commands
-- Always validate paths and inputs when possible"""
-
-    def _get_tools(self) -> List[Dict[str, Any]]:
-        """Define the tools available to Claude."""
-        return [
-            {
-                "name": "execute_bash",
-                "description": "Execute a bash command on the local machine. Returns stdout, stderr, and exit code. Use this to run any command including git, rg, gh, curl, etc. The command runs in the current working directory.",
-                "input_schema": {
-                    "type": "object",
-                    "properties": {
-                        "command": {
-                            "type": "string",
-                            "description": "The bash command to execute. Can be a single command or a pipeline."
-                        },
-                        "description": {
-                            "type": "string",
-                            "description": "A brief description of what this command does (for logging purposes)."
-                        }
-                    },
-                    "required": ["command", "description"]
-                }
-            }
-        ]
-    
     def _execute_bash(self, command: str, description: str) -> Dict[str, Any]:
         """Execute a bash command and return the result.
         
         WARNING: This executes arbitrary commands from Claude. Only use this CLI
         in environments where you trust Claude to execute commands safely.
         
-        Note: shell=True is required here to support pipes, redirects, and shell
-        features that Claude needs for complex tasks. This is an intentional design
-        choice for an agent that needs full shell capabilities.
+        Note: Claude needs pipes, redirects and other shell features for complex
+        tasks, so commands are not restricted to a single program. See
+        _run_command for how a command is executed.
         """
-        print(f"\n🔧 Executing: {description}")
-        print(f"   Command: {command}")
+        with self._print_lock:
+            print(f"\n🔧 Executing: {description}")
+            print(f"   Command: {command}")
+        
+        pure = _is_pure_command(command)
+        key = (os.getcwd(), command)
+        slot = hash(command) & (_NEG_CACHE_SIZE - 1)
+        with self._cmd_cache_lock:
+            cached = self._cmd_cache.get(key) if pure else None
+            if cached is not None:
+                self._cmd_cache.move_to_end(key)
+            failure = self._neg_cache[slot] if pure else None
+            if failure is not None and (failure[0] != key or time.monotonic() - failure[2] > _NEG_CACHE_TTL):
+                failure = None
+            generation = self._cmd_cache_generation
+        if cached is not None:
+            with self._print_lock:
+                print(f"   ✓ Cached (exit code: {cached['exit_code']})")
+            return dict(cached)
+        if failure is not None:
+            with self._print_lock:
+                print(f"   ✗ Failed, cached (exit code: {failure[1]['exit_code']})")
+            return dict(failure[1])
+        
+        started = time.monotonic()
+        output = self._run_command(command)
+        finished = time.monotonic()
+        
+        with self._cmd_cache_lock:
+            if not pure:
+                # The command may have changed files or repository state
+                self._clear_command_caches()
+                generation += 1
+            if generation == self._cmd_cache_generation:
+                if pure and output["success"]:
+                    self._cmd_cache[key] = dict(output)
+                    if len(self._cmd_cache) > self._cmd_cache_max:
+                        self._cmd_cache.popitem(last=False)
+                elif (pure and output["exit_code"] in _NEG_CACHE_EXIT_CODES
+                        and finished - started < _NEG_CACHE_MAX_DURATION):
+                    self._neg_cache[slot] = (key, dict(output), finished)
+        
+        return output
+    
+    def _clear_command_caches(self):
+        """Forget all cached command results; call with _cmd_cache_lock held."""
+        self._cmd_cache.clear()
+        self._neg_cache = [None] * _NEG_CACHE_SIZE
+        self._cmd_cache_generation += 1
+    
+    def _run_command(self, command: str) -> Dict[str, Any]:
+        """Run a command and return its output and exit code.
+        
+        There are three ways a command is executed:
         
+        1. Commands without any shell syntax are split with shlex and executed
+           directly (shell=False), without a shell in between.
+        2. Everything else, and commands that turn out to need a shell, go to
+           the persistent bash process if it is idle.
+        3. If that shell is busy with another tool call or cannot be started,
+           a new shell is spawned for this command alone (shell=True).
+        
+        Commands come from the Claude API, not from direct user input.
+        """
         try:
-            # shell=True is required for agent functionality (pipes, redirects, etc.)
-            # Commands come from Claude API, not direct user input
-            result = subprocess.run(
-                command,
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=self.command_timeout,
-                cwd=os.getcwd()
-            )
+            output = None
+            if not _SHELL_META_RE.search(command):
+                args = shlex.split(command)
+                if args:
+                    try:
+                        output = self._run_in_new_process(args, shell=False)
+                    except OSError:
+                        # Shell builtins, variable assignments and scripts
+                        # without a shebang need a shell
+                        output = None
             
-            output = {
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "exit_code": result.returncode,
-                "success": result.returncode == 0
-            }
-            
-            if output["success"]:
-                print(f"   ✓ Success (exit code: {result.returncode})")
-            else:
-                print(f"   ✗ Failed (exit code: {result.returncode})")
-            
-            return output
+            if output is None and self._shell_lock.acquire(blocking=False):
+                try:
+                    output = self._run_in_persistent_shell(command)
+                finally:
+                    self._shell_lock.release()
             
-        except subprocess.TimeoutExpired:
-            return {
-                "stdout": "",
-                "stderr": f"Command timed out after {self.command_timeout} seconds",
-                "exit_code": -1,
-                "success": False
-            }
+            if output is None:
+                output = self._run_in_new_process(command, shell=True)
         except Exception as e:
             return {
                 "stdout": "",
@@ -139,22 +404,464 @@ IMPORTANT SECURITY NOTE: You are executing commands on the user's machine. Be ca
                 "exit_code": -1,
                 "success": False
             }
+        
+        if output["exit_code"] is None:
+            output["stderr"] = (output["stderr"] + "\n" if output["stderr"] else "") + \
+                f"Command timed out after {self.command_timeout} seconds"
+            output["exit_code"] = -1
+            output["success"] = False
+            return output
+        
+        with self._print_lock:
+            if output["success"]:
+                print(f"   ✓ Success (exit code: {output['exit_code']})")
+            else:
+                print(f"   ✗ Failed (exit code: {output['exit_code']})")
+        
+        return output
+    
+    def _run_in_new_process(self, command: Union[str, List[str]], shell: bool) -> Dict[str, Any]:
+        """Run a command in a newly spawned process.
+        
+        Args:
+            command: Command line for a shell, or argument list if shell is False
+            shell: Whether to run the command through a shell
+        
+        Returns a result dict whose exit_code is None if the command timed out.
+        
+        The arguments are chosen so that subprocess can start the process with
+        posix_spawn instead of fork, which would have to copy the page tables of
+        the whole interpreter: the executable is given by path, the child
+        inherits the working directory rather than getting cwd, and file
+        descriptors are only closed where posix_spawn supports it (3.13+).
+        """
+        executable = None
+        if not shell:
+            executable = shutil.which(command[0])
+            if executable is None:
+                raise FileNotFoundError(f"Command not found: {command[0]}")
+        
+        process = subprocess.Popen(
+            command,
+            shell=shell,
+            executable=executable,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=sys.version_info >= (3, 13),
+            bufsize=0
+        )
+        try:
+            stdout, stderr, _, timed_out = self._collect_output(
+                process.stdout, process.stderr, interrupt=process.kill
+            )
+        finally:
+            process.stdout.close()
+            process.stderr.close()
+            process.wait()
+        
+        exit_code = None if timed_out else process.returncode
+        return {
+            "stdout": stdout,
+            "stderr": stderr,
+            "exit_code": exit_code,
+            "success": exit_code == 0
+        }
+    
+    def _run_in_persistent_shell(self, command: str) -> Optional[Dict[str, Any]]:
+        """Run a command through the long-lived bash process.
+        
+        Saves spawning a shell per command. Each command runs in a subshell
+        (a fork, but no exec), so exports, options, traps and the like don't
+        leak into later commands. It starts from the current working
+        directory with stdin from /dev/null. Its output goes to two FIFOs
+        created for this command alone, which are read up to EOF just like
+        the pipes of a spawned process; background jobs can't write into
+        the result of a later command. The shell then writes the exit code
+        to its own stdout.
+        
+        Returns None if the shell is not available or the FIFOs can't be set
+        up; otherwise a result dict
+        whose exit_code is None if the command timed out.
+        """
+        if self._shell is None or self._shell.poll() is not None:
+            self._discard_shell()
+            if not self._start_shell():
+                return None
+        shell = self._shell
+        
+        paths = [os.path.join(self._shell_dir, name) for name in ("stdout", "stderr")]
+        created: List[str] = []
+        readers = []
+        # Extra write ends keep the FIFOs from reporting EOF before the shell
+        # opened them; they are closed once the command has finished
+        writers: List[int] = []
+        
+        def release():
+            while writers:
+                os.close(writers.pop())
+        
+        script = (
+            f"( cd -- {shlex.quote(os.getcwd())} && eval -- {shlex.quote(command)} )"
+            f" < /dev/null > {shlex.quote(paths[0])} 2> {shlex.quote(paths[1])}; "
+            f"printf '{_SENTINEL}%d\\n' $?\n"
+        )
+        try:
+            try:
+                for path in paths:
+                    os.mkfifo(path)
+                    created.append(path)
+                for path in paths:
+                    readers.append(open(os.open(path, os.O_RDONLY | os.O_NONBLOCK), "rb", buffering=0))
+                for path in paths:
+                    writers.append(os.open(path, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                # E.g. out of file descriptors; let the caller fall back to
+                # a new process
+                return None
+            
+            try:
+                shell.stdin.write(script.encode())
+            except OSError:
+                self._discard_shell()
+                return None
+            
+            stdout, stderr, exit_code, timed_out = self._collect_output(
+                readers[0], readers[1],
+                # Killing the whole group makes sure no later part of a command
+                # list runs after the timeout
+                interrupt=lambda: _kill_process_group(shell.pid),
+                status=shell.stdout,
+                release=release
+            )
+        finally:
+            release()
+            for reader in readers:
+                reader.close()
+            for path in created:
+                os.unlink(path)
+        
+        if exit_code is None:
+            # The shell was killed on timeout or by _stop_shell
+            self._discard_shell()
+            if not timed_out:
+                exit_code = shell.returncode
+        if timed_out:
+            exit_code = None
+        
+        return {
+            "stdout": stdout,
+            "stderr": stderr,
+            "exit_code": exit_code,
+            "success": exit_code == 0
+        }
+    
+    def _start_shell(self) -> bool:
+        """Start the persistent bash process; return False if that fails."""
+        try:
+            self._shell = subprocess.Popen(
+                ["bash", "--noprofile", "--norc"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                cwd=os.getcwd(),
+                bufsize=0,
+                start_new_session=True
+            )
+        except OSError:
+            return False
+        self._shell_dir = tempfile.mkdtemp(prefix="simple-claude-cli-")
+        return True
+    
+    def _discard_shell(self):
+        """Kill the persistent bash process and release its pipes.
+        
+        Must only be called while holding _shell_lock, so no worker is
+        reading from the pipes that are closed here.
+        """
+        shell, self._shell = self._shell, None
+        if self._shell_dir is not None:
+            shutil.rmtree(self._shell_dir, ignore_errors=True)
+            self._shell_dir = None
+        if shell is None:
+            return
+        _kill_process_group(shell.pid)
+        for stream in (shell.stdin, shell.stdout):
+            stream.close()
+        shell.wait()
+    
+    def _stop_shell(self):
+        """Kill the persistent bash process and everything it started.
+        
+        If a worker is running a command in the shell, only the process group
+        is killed; the worker then reads EOF and discards the shell itself.
+        """
+        shell = self._shell
+        if shell is None:
+            return
+        if self._shell_lock.acquire(blocking=False):
+            try:
+                self._discard_shell()
+            finally:
+                self._shell_lock.release()
+        else:
+            _kill_process_group(shell.pid)
     
-    def _process_tool_call(self, tool_name: str, tool_input: Dict[str, Any]) -> str:
-        """Process a tool call and return the result."""
+    def close(self):
+        """Stop the persistent shell and the tool call workers."""
+        self._stop_shell()
+        self._pool.shutdown(wait=False)
+    
+    def _collect_output(
+        self,
+        stdout,
+        stderr,
+        interrupt: Callable[[], None],
+        status=None,
+        release: Optional[Callable[[], None]] = None
+    ) -> Tuple[str, str, Optional[int], bool]:
+        """Stream a command's output to the terminal while capturing it.
+        
+        Only the start and end of each stream are captured (see _OutputCapture).
+        Once command_timeout is exceeded, interrupt is called and reading goes
+        on for at most _KILL_GRACE more seconds.
+        
+        Args:
+            stdout: Pipe connected to the command's stdout, read up to EOF
+            stderr: Pipe connected to the command's stderr, read up to EOF
+            interrupt: Called to stop the command on timeout
+            status: Pipe the persistent shell writes the exit code line to
+            release: Called once the exit code line arrived, the status pipe
+                was closed or the command timed out
+        
+        Returns:
+            Tuple of (stdout, stderr, exit code from the status pipe or None, timed_out)
+        """
+        tees = {
+            stdout: sys.stdout.buffer,
+            stderr: sys.stderr.buffer,
+        }
+        captures = {stream: _OutputCapture() for stream in tees}
+        status_buffer = bytearray()
+        exit_code = None
+        
+        selector = selectors.DefaultSelector()
+        for stream in (stdout, stderr, status):
+            if stream is not None:
+                os.set_blocking(stream.fileno(), False)
+                selector.register(stream, selectors.EVENT_READ)
+        
+        sys.stdout.flush()
+        deadline = time.monotonic() + self.command_timeout
+        timed_out = False
+        try:
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if timed_out:
+                        break
+                    timed_out = True
+                    interrupt()
+                    if release is not None:
+                        release()
+                    deadline = time.monotonic() + _KILL_GRACE
+                    continue
+                for key, _ in selector.select(remaining):
+                    stream = key.fileobj
+                    try:
+                        chunk = os.read(key.fd, 65536)
+                    except BlockingIOError:
+                        continue
+                    
+                    if stream is status:
+                        status_buffer += chunk
+                        match = _SENTINEL_RE.search(status_buffer)
+                        if match or not chunk:
+                            if match:
+                                exit_code = int(match.group(1))
+                            selector.unregister(stream)
+                            release()
+                        continue
+                    
+                    if not chunk:
+                        selector.unregister(stream)
+                        continue
+                    with self._print_lock:
+                        tees[stream].write(chunk)
+                        tees[stream].flush()
+                    captures[stream].feed(chunk)
+        finally:
+            selector.close()
+        
+        return captures[stdout].text(), captures[stderr].text(), exit_code, timed_out
+    
+    def _process_tool_call(self, tool_name: str, tool_input: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Process a tool call and return the result as tool_result content blocks.
+        
+        The command output is put into a plain text block rather than a JSON
+        document, so it is only escaped once when the request is serialized.
+        """
         if tool_name == "execute_bash":
             result = self._execute_bash(
                 command=tool_input["command"],
                 description=tool_input.get("description", "Running command")
             )
-            return json.dumps(result, indent=2)
+            text = (
+                f"exit_code={result['exit_code']}\n"
+                f"--- stdout ---\n{result['stdout']}\n"
+                f"--- stderr ---\n{result['stderr']}"
+            )
+        else:
+            text = f"Unknown tool: {tool_name}"
+        return [{"type": "text", "text": text}]
+    
+    def _append_message(self, message: Dict[str, Any]):
+        """Add a message to the conversation history."""
+        self.conversation_history.append(message)
+        self._messages_view = None
+    
+    def _messages_for_request(self) -> List[Dict[str, Any]]:
+        """Return the conversation with a cache breakpoint on the last turn.
+        
+        This lets the next request read the whole conversation so far from
+        the prompt cache. The breakpoint is added to a copy, so older turns
+        in the history never carry stale breakpoints. The list is built once
+        per new message and reused, e.g. when a request is retried.
+        """
+        if self._messages_view is not None:
+            return self._messages_view
+        
+        messages = list(self.conversation_history)
+        last = messages[-1]
+        content = last["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
         else:
-            return json.dumps({"error": f"Unknown tool: {tool_name}"})
+            content = list(content)
+        content[-1] = dict(content[-1], cache_control={"type": "ephemeral"})
+        messages[-1] = dict(last, content=content)
+        self._messages_view = messages
+        return messages
+    
+    def _compact_history(self):
+        """Shorten old tool results to keep the prompt within its token budget.
+        
+        Once the conversation exceeds _max_history_tokens, the text of tool
+        results is cut to its first 512 characters, starting with the oldest
+        message, until the estimate is down to half the budget. The first
+        message, the user's original request, and the newest message, which
+        Claude has not seen yet, are always kept.
+        
+        Shortening a message changes the prompt from that message on, so the
+        cached prefix up to the previous request's cache breakpoint can't be
+        read anymore. Compacting in batches means this happens once every
+        many turns instead of on every turn once the budget is reached.
+        """
+        history = self.conversation_history
+        sizes = [_estimate_tokens(message) for message in history]
+        used = sum(sizes)
+        if used <= self._max_history_tokens:
+            return
+        
+        target = self._max_history_tokens // 2
+        for message, size in islice(zip(history, sizes), 1, len(history) - 1):
+            if used <= target:
+                break
+            if message["role"] != "user" or isinstance(message["content"], str):
+                continue
+            for block in message["content"]:
+                if block.get("type") != "tool_result":
+                    continue
+                for part in block["content"]:
+                    text = part.get("text", "")
+                    if len(text) > 1024:
+                        part["text"] = text[:512] + f"...[truncated {len(text) - 512} bytes]"
+            used += _estimate_tokens(message) - size
+    
+    async def _pace_requests(self):
+        """Sleep as needed to stay below requests_per_minute."""
+        if not self.requests_per_minute:
+            return
+        
+        now = time.monotonic()
+        while self._request_times and now - self._request_times[0] >= 60:
+            self._request_times.popleft()
+        if len(self._request_times) >= self.requests_per_minute:
+            await asyncio.sleep(60 - (now - self._request_times[0]))
+            self._request_times.popleft()
+        self._request_times.append(time.monotonic())
+    
+    async def _stream_response(self):
+        """Stream the next assistant message to the terminal and return it.
+        
+        Rate limit (429), timeout and conflict (408, 409), server (5xx) and
+        connection errors are retried up to max_retries times with backoff,
+        as are overload and server errors reported in the middle of the
+        stream; other errors are raised immediately.
+        """
+        import anthropic
+        import httpx
+        
+        attempt = 0
+        while True:
+            self._compact_history()
+            await self._pace_requests()
+            streamed_text = False
+            try:
+                # Stream the response so text shows up as soon as it is generated
+                async with self.client.messages.stream(
+                    model=self.model,
+                    max_tokens=4096,
+                    system=self.system_prompt,
+                    messages=self._messages_for_request(),
+                    tools=_get_tools()
+                ) as stream:
+                    async for text in stream.text_stream:
+                        if not streamed_text:
+                            sys.stdout.write("\n🤖 Claude: ")
+                            streamed_text = True
+                        sys.stdout.write(text)
+                        sys.stdout.flush()
+                    return await stream.get_final_message()
+            except anthropic.APIStatusError as e:
+                if isinstance(e, anthropic.RateLimitError):
+                    delay = _retry_delay(e.response.headers, attempt)
+                elif _is_retryable_status_error(e.status_code, e.body):
+                    delay = min(60.0, 2 ** attempt + random.random())
+                else:
+                    raise
+                if attempt >= self.max_retries:
+                    raise
+                if e.status_code == 200:
+                    reason = f"API error in the response stream ({e.body['error']['type']})"
+                else:
+                    reason = f"API error {e.status_code}"
+            except (anthropic.APIConnectionError, httpx.TransportError) as e:
+                # Also covers APITimeoutError, and transport errors such as a
+                # read timeout or a dropped connection while the response is
+                # streamed, which the SDK does not wrap
+                if attempt >= self.max_retries:
+                    raise
+                delay = min(60.0, 2 ** attempt + random.random())
+                reason = f"Connection error ({e})"
+            finally:
+                if streamed_text:
+                    print()
+            
+            attempt += 1
+            print(f"\n⏳ {reason}, retrying in {delay:.1f}s ({attempt}/{self.max_retries})...")
+            if streamed_text:
+                print("   The response was interrupted and will be repeated from the start.")
+            await asyncio.sleep(delay)
     
-    def chat(self, user_message: str) -> str:
+    async def chat(self, user_message: str) -> str:
         """Send a message to Claude and handle tool calls in a loop."""
+        # The user may have changed files since the last request
+        with self._cmd_cache_lock:
+            self._clear_command_caches()
+        
         # Add user message to history
-        self.conversation_history.append({
+        self._append_message({
             "role": "user",
             "content": user_message
         })
@@ -164,20 +871,14 @@ IMPORTANT SECURITY NOTE: You are executing commands on the user's machine. Be ca
         while True:
             # Make API call
             try:
-                response = self.client.messages.create(
-                    model=self.model,
-                    max_tokens=4096,
-                    system=self.system_prompt,
-                    messages=self.conversation_history,
-                    tools=self._get_tools()
-                )
+                response = await self._stream_response()
             except Exception as e:
                 error_msg = f"API Error: {str(e)}"
                 print(f"\n❌ {error_msg}")
                 return error_msg
             
             # Add assistant response to history
-            self.conversation_history.append({
+            self._append_message({
                 "role": "assistant",
                 "content": response.content
             })
@@ -192,19 +893,19 @@ IMPORTANT SECURITY NOTE: You are executing commands on the user's machine. Be ca
                 elif block.type == "tool_use":
                     tool_calls.append(block)
             
-            # Display text responses
-            if text_responses:
-                response_text = "\n".join(text_responses)
-                print(f"\n🤖 Claude: {response_text}")
-            
             # If no tool calls, we're done
             if not tool_calls:
                 return "\n".join(text_responses) if text_responses else ""
             
-            # Execute tool calls
+            # Execute tool calls concurrently in the worker threads. gather()
+            # keeps the original order, so every tool_use_id gets its result.
+            loop = asyncio.get_running_loop()
+            results = await asyncio.gather(*(
+                loop.run_in_executor(self._pool, self._process_tool_call, tool_call.name, tool_call.input)
+                for tool_call in tool_calls
+            ))
             tool_results = []
-            for tool_call in tool_calls:
-                result = self._process_tool_call(tool_call.name, tool_call.input)
+            for tool_call, result in zip(tool_calls, results):
                 tool_results.append({
                     "type": "tool_result",
                     "tool_use_id": tool_call.id,
@@ -212,7 +913,7 @@ IMPORTANT SECURITY NOTE: You are executing commands on the user's machine. Be ca
                 })
             
             # Add tool results to history and continue the loop
-            self.conversation_history.append({
+            self._append_message({
                 "role": "user",
                 "content": tool_results
             })
@@ -228,37 +929,43 @@ IMPORTANT SECURITY NOTE: You are executing commands on the user's machine. Be ca
         print("=" * 60)
         
         is_tty = sys.stdin.isatty()
+        # One event loop for the whole session, so the API client can keep
+        # its connections open between requests. Input is read outside of
+        # the loop as nothing else runs while waiting for the user.
+        loop = asyncio.new_event_loop()
         
         try:
             while True:
                 try:
-                    if is_tty:
-                        print("\n" + ">" * 3 + " Your request (end with empty line):")
+                    if not is_tty:
+                        # Piped input is a single request, read in one go
+                        user_input = sys.stdin.read().strip()
+                        if user_input:
+                            loop.run_until_complete(self.chat(user_input))
+                        raise EOFError
+                    
+                    print("\n" + ">" * 3 + " Your request (end with empty line):")
                     
                     # Read lines until we get an empty line or EOF
                     lines = []
                     while True:
-                        try:
-                            line = sys.stdin.readline()
-                            if not line:  # EOF
-                                if not lines:
-                                    raise EOFError
-                                break
-                            line = line.rstrip('\n\r')
-                            if not line and lines:  # Empty line after some input
-                                break
-                            if line:  # Non-empty line
-                                lines.append(line)
-                        except KeyboardInterrupt:
-                            raise
+                        line = sys.stdin.readline()
+                        if not line:  # EOF
+                            if not lines:
+                                raise EOFError
+                            break
+                        line = line.rstrip('\n\r')
+                        if not line and lines:  # Empty line after some input
+                            break
+                        if line:  # Non-empty line
+                            lines.append(line)
                     
                     if not lines:
-                        if is_tty:
-                            print("\nEmpty input.")
+                        print("\nEmpty input.")
                         continue
                     
                     user_input = "\n".join(lines)
-                    self.chat(user_input)
+                    loop.run_until_complete(self.chat(user_input))
                     
                 except EOFError:
                     # Ctrl-D pressed or stdin closed
@@ -271,6 +978,10 @@ IMPORTANT SECURITY NOTE: You are executing commands on the user's machine. Be ca
             print("\n\n" + "=" * 60)
             print("Session interrupted. Goodbye!")
             print("=" * 60)
+        finally:
+            self.close()
+            loop.run_until_complete(self._http.aclose())
+            loop.close()
 
 
 def main():